@@ -1,15 +1,23 @@
 import os
-import requests
+import asyncio
+import httpx
 import json
-import re
+import orjson
 import fitz  # PyMuPDF library
 import docx  # python-docx library
 import hashlib
+import mmap
 import sqlite3
 import subprocess
+import threading
 import sys
 import math
 import shutil
+import queue
+import atexit
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from tqdm import tqdm
@@ -20,7 +28,30 @@ CORS(app)  # Enable CORS for all routes
 # --- Configuration ---
 LLM_URL = "http://localhost:1234/v1/chat/completions"
 DATABASE_FILE = "file_organizer.db"
-SUPPORTED_EXTENSIONS = ['.pdf', '.txt', '.docx', '.jpg', '.jpeg', '.png', '.gif', '.mp3', '.wav', '.m4a']
+SUPPORTED_EXTENSIONS = frozenset(['.pdf', '.txt', '.docx', '.jpg', '.jpeg', '.png', '.gif', '.mp3', '.wav', '.m4a'])
+SQLITE_MAX_VARIABLES = 999  # Conservative bound on host parameters per statement
+LLM_NUM_PARALLEL = int(os.environ.get("LLM_NUM_PARALLEL", "4"))  # Max concurrent requests to the LLM server
+_SANITIZE_TABLE = str.maketrans({c: '_' for c in '\\/:*?"<>|'})
+RENAME_WORKERS = 16
+# Extraction workers must not be forked from a threaded request handler, as they could inherit held locks
+PROCESS_POOL_CONTEXT = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+POOLED_TEXT_EXTENSIONS = frozenset(['.pdf', '.docx'])  # CPU-heavy parsers worth a worker process; the rest are read inline
+MAX_TEXT_CHARS = 12000  # Document text budget for the LLM prompt; extraction stops once it is reached
+PROMPT_VERSION = 1  # Bump whenever the LLM prompt changes so cached analyses are redone
+# JSON schema the LLM server constrains its output to, matching the keys the system prompt asks for
+LLM_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "topic": {"type": "string"},
+        "synopsis": {"type": "string"},
+        "speakers": {"type": "array", "items": {"type": "string"}},
+        "date": {"type": "string"},
+        "setting": {"type": "string"},
+        "subject": {"type": "string"},
+    },
+    "required": ["topic", "synopsis", "speakers", "date", "setting", "subject"],
+    "additionalProperties": False,  # Required by OpenAI-style strict mode
+}
 
 # --- Helper Functions ---
 def is_exiftool_installed():
@@ -28,10 +59,26 @@ def is_exiftool_installed():
     return shutil.which("exiftool") is not None
 
 # --- Database Setup ---
+DB = None  # Shared connection, opened by init_db()
+DB_LOCK = threading.Lock()  # Serializes use of DB across request threads
+
+FTS_COLUMNS = "topic, summary, original_name, new_name, speakers, metadata"
+
+def _fts_values(row_alias):
+    return ", ".join(f"{row_alias}.{col.strip()}" for col in FTS_COLUMNS.split(","))
+
+def to_fts_query(query):
+    """Turns free text into an FTS5 query that prefix-matches every word, escaping FTS syntax."""
+    return " ".join('"' + term.replace('"', '""') + '"*' for term in query.split())
+
 def init_db():
-    """Initializes the SQLite database and creates/updates the 'files' table."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    """Opens the shared SQLite connection and creates/updates the 'files' table."""
+    global DB
+    DB = sqlite3.connect(DATABASE_FILE, check_same_thread=False)
+    DB.execute("PRAGMA journal_mode=WAL")
+    DB.execute("PRAGMA synchronous=NORMAL")
+    DB.execute("PRAGMA temp_store=MEMORY")
+    cursor = DB.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS files (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -45,6 +92,8 @@ def init_db():
             speakers TEXT,
             file_type TEXT,
             metadata TEXT,
+            names_hash TEXT,
+            prompt_version INTEGER,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
@@ -58,8 +107,59 @@ def init_db():
         cursor.execute("ALTER TABLE files ADD COLUMN original_path TEXT")
     except sqlite3.OperationalError:
         pass # Column already exists
-    conn.commit()
-    conn.close()
+    # Add names_hash and prompt_version columns identifying what produced the stored analysis
+    for column in ("names_hash TEXT", "prompt_version INTEGER"):
+        try:
+            cursor.execute(f"ALTER TABLE files ADD COLUMN {column}")
+        except sqlite3.OperationalError:
+            pass # Column already exists
+    # file_hash is already indexed through its UNIQUE constraint
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_original_path ON files(original_path)")
+    # Full-text index over the searchable columns, kept in sync with 'files' by triggers
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files_fts'")
+    fts_exists = cursor.fetchone() is not None
+    cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5({FTS_COLUMNS}, content='files', content_rowid='id')")
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS files_fts_insert AFTER INSERT ON files BEGIN
+            INSERT INTO files_fts(rowid, {FTS_COLUMNS}) VALUES (new.id, {_fts_values('new')});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS files_fts_delete AFTER DELETE ON files BEGIN
+            INSERT INTO files_fts(files_fts, rowid, {FTS_COLUMNS}) VALUES ('delete', old.id, {_fts_values('old')});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS files_fts_update AFTER UPDATE ON files BEGIN
+            INSERT INTO files_fts(files_fts, rowid, {FTS_COLUMNS}) VALUES ('delete', old.id, {_fts_values('old')});
+            INSERT INTO files_fts(rowid, {FTS_COLUMNS}) VALUES (new.id, {_fts_values('new')});
+        END
+    ''')
+    if not fts_exists:
+        cursor.execute("INSERT INTO files_fts(files_fts) VALUES ('rebuild')")  # Index rows from older databases
+    # Hashes of files seen before, keyed by identity and last modification, so unchanged files aren't re-read
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stat_cache (
+            dev INTEGER NOT NULL,
+            ino INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            file_hash TEXT NOT NULL,
+            PRIMARY KEY (dev, ino)
+        )
+    ''')
+    DB.commit()
+
+def find_cached_analyses(cursor, file_hashes):
+    """Maps each of file_hashes already in the database to its stored (names_hash, prompt_version)."""
+    file_hashes = list(file_hashes)
+    cached = {}
+    for i in range(0, len(file_hashes), SQLITE_MAX_VARIABLES):
+        chunk = file_hashes[i:i + SQLITE_MAX_VARIABLES]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f"SELECT file_hash, names_hash, prompt_version FROM files WHERE file_hash IN ({placeholders})", chunk)
+        cached.update((row[0], (row[1], row[2])) for row in cursor.fetchall())
+    return cached
 
 # --- File Processing Utilities ---
 
@@ -67,19 +167,80 @@ def calculate_file_hash(file_path, block_size=65536):
     hasher = hashlib.sha256()
     try:
         with open(file_path, 'rb') as f:
-            buf = f.read(block_size)
-            while len(buf) > 0:
-                hasher.update(buf)
+            if os.fstat(f.fileno()).st_size > 0:
+                # Hand the whole file to OpenSSL as one buffer instead of looping in Python
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    hasher.update(mm)
+            else:
+                # Empty files (and some special files) can't be mapped
                 buf = f.read(block_size)
+                while len(buf) > 0:
+                    hasher.update(buf)
+                    buf = f.read(block_size)
         return hasher.hexdigest()
     except Exception as e:
         print(f"Error calculating hash for {file_path}: {e}")
         return None
 
+def load_known_names(directory_path):
+    """Reads the directory's names.txt, returning the names formatted for the prompt and a hash of the file."""
+    content = b""  # A missing file is treated the same as an empty one
+    names_file_path = os.path.join(directory_path, 'names.txt')
+    if os.path.exists(names_file_path):
+        with open(names_file_path, 'rb') as f:
+            content = f.read()
+    known_names = [line.strip() for line in content.decode('utf-8').splitlines() if line.strip()]
+    names_block = "\n".join([f"- {name}" for name in known_names])
+    return names_block, hashlib.sha256(content).hexdigest()
+
+def iter_supported_files(directory_path):
+    """Yields the paths of supported files under directory_path as the walk finds them."""
+    # scandir's DirEntry caches the type from the directory listing, so most entries need no extra stat
+    try:
+        entries = os.scandir(directory_path)
+    except OSError:
+        return  # Unreadable directory, skipped like os.walk does
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_supported_files(entry.path)
+            elif entry.is_file():
+                dot = entry.name.rfind('.')
+                if dot > 0 and entry.name[dot:].lower() in SUPPORTED_EXTENSIONS:
+                    yield entry.path
+
+def _hash_one(file_path):
+    """Returns (file_path, file_hash, stat_cache_row); the row is None when nothing new needs caching."""
+    try:
+        st = os.stat(file_path)
+    except OSError as e:
+        print(f"Error calculating hash for {file_path}: {e}")
+        return file_path, None, None
+    # Some filesystems report no inode numbers, and SQLite integers are 64-bit signed
+    if not 0 < st.st_ino < 2 ** 63:
+        return file_path, calculate_file_hash(file_path), None
+    stat_key = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+    with DB_LOCK:
+        row = DB.execute("SELECT file_hash FROM stat_cache WHERE dev = ? AND ino = ? AND mtime_ns = ? AND size = ?", stat_key).fetchone()
+    if row:
+        return file_path, row[0], None
+    file_hash = calculate_file_hash(file_path)
+    return file_path, file_hash, (stat_key + (file_hash,) if file_hash else None)
+
 def get_text_from_pdf(file_path):
     try:
+        parts = []
+        total_chars = 0
         with fitz.open(file_path) as doc:
-            return "".join(page.get_text() for page in doc).strip()
+            for i in range(doc.page_count):
+                page = doc.load_page(i)
+                text = page.get_text("text")
+                page = None  # Release each page before loading the next
+                parts.append(text)
+                total_chars += len(text)
+                if total_chars >= MAX_TEXT_CHARS: break
+        fitz.TOOLS.store_shrink(100)  # Free MuPDF's resource cache between documents
+        return "".join(parts).strip()[:MAX_TEXT_CHARS]
     except Exception as e:
         print(f"Error reading PDF {file_path}: {e}")
         return None
@@ -87,7 +248,7 @@ def get_text_from_pdf(file_path):
 def get_text_from_txt(file_path):
     try:
         with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            return f.read().strip()
+            return f.read(MAX_TEXT_CHARS).strip()
     except Exception as e:
         print(f"Error reading TXT {file_path}: {e}")
         return None
@@ -95,7 +256,13 @@ def get_text_from_txt(file_path):
 def get_text_from_docx(file_path):
     try:
         doc = docx.Document(file_path)
-        return "\n".join([para.text for para in doc.paragraphs]).strip()
+        parts = []
+        total_chars = 0
+        for para in doc.paragraphs:
+            parts.append(para.text)
+            total_chars += len(para.text) + 1
+            if total_chars >= MAX_TEXT_CHARS: break
+        return "\n".join(parts).strip()[:MAX_TEXT_CHARS]
     except Exception as e:
         print(f"Error reading DOCX {file_path}: {e}")
         return None
@@ -107,30 +274,171 @@ def get_file_content(file_path):
     elif ext == '.docx': return get_text_from_docx(file_path)
     return "" # Return empty string for non-text files, metadata will be used
 
+_extraction_pool = None
+_extraction_pool_lock = threading.Lock()
+
+def get_extraction_pool():
+    """Lazily starts the long-lived process pool used for PDF/DOCX text extraction."""
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            _extraction_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=PROCESS_POOL_CONTEXT)
+        return _extraction_pool
+
+def discard_extraction_pool(pool):
+    """Drops a broken pool so the next caller starts a fresh one."""
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is pool:
+            _extraction_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _extract_isolated(file_path):
+    """Retries one file in its own single-worker pool, so a crash only affects that file."""
+    try:
+        with ProcessPoolExecutor(max_workers=1, mp_context=PROCESS_POOL_CONTEXT) as executor:
+            return executor.submit(get_file_content, file_path).result()
+    except BrokenProcessPool as e:
+        print(f"Error extracting text from {file_path}: worker crashed ({e})")
+        return None
+
+def extract_texts(file_paths):
+    """Extracts text for each path, sending PDF/DOCX files to the process pool and reading the rest inline."""
+    texts = {}
+    futures = {}
+    pool = get_extraction_pool()
+    for file_path in file_paths:
+        if os.path.splitext(file_path)[1].lower() in POOLED_TEXT_EXTENSIONS:
+            try:
+                futures[file_path] = pool.submit(get_file_content, file_path)
+            except BrokenProcessPool:
+                futures[file_path] = None  # Retried in isolation below
+        else:
+            texts[file_path] = get_file_content(file_path)
+    # A crashed worker breaks the whole pool, so files it hadn't finished are retried one at a time.
+    # They are never parsed in this process, where the same crash would take down the server.
+    pool_broken = False
+    for file_path, future in tqdm(futures.items(), desc="Extracting Files", unit="file"):
+        try:
+            if future is None:
+                raise BrokenProcessPool("pool was already broken")
+            texts[file_path] = future.result()
+        except BrokenProcessPool:
+            pool_broken = True
+            texts[file_path] = _extract_isolated(file_path)
+    if pool_broken:
+        discard_extraction_pool(pool)
+    return [texts[file_path] for file_path in file_paths]
+
+class ExifToolDaemon:
+    """A long-lived `exiftool -stay_open` process that reads commands from stdin."""
+    READY_SENTINEL = "{ready}"
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            ["exiftool", "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            # surrogateescape passes undecodable POSIX filenames through as their original bytes
+            text=True, encoding='utf-8', errors='surrogateescape'
+        )
+
+    def execute(self, *args):
+        """Runs one exiftool command and returns its stdout up to the {ready} sentinel."""
+        self.process.stdin.write("\n".join(args) + "\n-execute\n")
+        self.process.stdin.flush()
+        output = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise RuntimeError("ExifTool process exited unexpectedly.")
+            if line.strip() == self.READY_SENTINEL:
+                return "".join(output)
+            output.append(line)
+
+    def close(self):
+        try:
+            self.process.stdin.write("-stay_open\nFalse\n")
+            self.process.stdin.flush()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+
+_exiftool_pool = None
+_exiftool_pool_lock = threading.Lock()
+
+def get_exiftool_pool():
+    """Lazily starts one ExifTool daemon per CPU and returns the queue holding them."""
+    global _exiftool_pool
+    with _exiftool_pool_lock:  # Concurrent scans must not each start a set of daemons
+        if _exiftool_pool is None:
+            pool = queue.Queue()
+            for _ in range(os.cpu_count() or 1):
+                pool.put(ExifToolDaemon())
+            atexit.register(lambda: [daemon.close() for daemon in list(pool.queue)])
+            _exiftool_pool = pool
+    return _exiftool_pool
+
+def _get_metadata_shard(file_paths):
+    """Runs one ExifTool command over a shard of files on a pooled daemon."""
+    pool = get_exiftool_pool()
+    daemon = pool.get()
+    try:
+        output = daemon.execute("-j", "-G", *file_paths)
+    except (RuntimeError, OSError, ValueError) as e:
+        print(f"Error getting metadata for {len(file_paths)} files: {e}")
+        daemon.close()
+        daemon = ExifToolDaemon()  # Replace the dead process
+        return {}
+    finally:
+        pool.put(daemon)
+    try:
+        # ExifTool returns one dictionary per readable file, keyed by SourceFile
+        return {m['SourceFile']: m for m in json.loads(output)}
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        print(f"Error parsing metadata for {len(file_paths)} files: {e}")
+        return {}
+
 def get_external_metadata(file_path):
-    """Extracts metadata using ExifTool."""
-    if not is_exiftool_installed():
-        return {"Error": "ExifTool not found. Please install it to extract rich metadata."}
+    """Extracts metadata for one file with its own ExifTool process."""
     try:
         result = subprocess.run(
             ["exiftool", "-j", "-G", file_path],
             capture_output=True, text=True, check=True
         )
         # ExifTool returns a list of dictionaries, we only need the first one
-        metadata = json.loads(result.stdout)[0]
-        return metadata
-    except (subprocess.CalledProcessError, json.JSONDecodeError, IndexError) as e:
+        return json.loads(result.stdout)[0]
+    except (subprocess.CalledProcessError, OSError, ValueError, IndexError) as e:
         print(f"Error getting metadata for {file_path}: {e}")
         return {"Error": f"Could not extract metadata. {e}"}
 
-def get_llm_analysis(text_content, metadata, directory_path):
-    """Sends a request to the local LLM for analysis."""
-    known_names = []
-    names_file_path = os.path.join(directory_path, 'names.txt')
-    if os.path.exists(names_file_path):
-        with open(names_file_path, 'r', encoding='utf-8') as f:
-            known_names = [line.strip() for line in f if line.strip()]
-
+def get_external_metadata_batch(file_paths):
+    """Extracts metadata for many files using one ExifTool command per CPU shard."""
+    if not is_exiftool_installed():
+        return {p: {"Error": "ExifTool not found. Please install it to extract rich metadata."} for p in file_paths}
+    results = {}
+    # The daemon's argfile is line-based, so paths containing newlines get their own process
+    batch_paths = []
+    for file_path in file_paths:
+        if '\n' in file_path or '\r' in file_path:
+            results[file_path] = get_external_metadata(file_path)
+        else:
+            batch_paths.append(file_path)
+    if not batch_paths:
+        return results
+    shard_count = min(os.cpu_count() or 1, len(batch_paths))
+    shards = [batch_paths[i::shard_count] for i in range(shard_count)]
+    metas = {}
+    with ThreadPoolExecutor(max_workers=shard_count) as executor:
+        for shard_metas in executor.map(_get_metadata_shard, shards):
+            metas.update(shard_metas)
+    for file_path in batch_paths:
+        # ExifTool reports paths with forward slashes, even on Windows
+        metadata = metas.get(file_path) or metas.get(file_path.replace(os.sep, '/'))
+        results[file_path] = metadata if metadata else {"Error": "Could not extract metadata."}
+    return results
+
+async def get_llm_analysis_async(client, semaphore, text_content, metadata, names_block):
+    """Sends a request to the local LLM for analysis, limited by the shared semaphore."""
     system_prompt = """You are an expert assistant for analyzing document content and metadata. Your task is to carefully read the provided text and file metadata to extract information. Use the metadata to enrich your understanding.
 You have a 'Known Correct Names' list. If you see garbled or phonetically similar names, you MUST use the correct spelling from the list.
 For transcripts, prioritize extracting the date, setting, and a clear subject.
@@ -143,36 +451,130 @@ Format your response as a single, valid JSON object with the following keys:
 - "subject": A clear, one-line subject of the meeting/document. Default to "N/A".
 Ensure the output is only the JSON object itself, with no extra text or markdown."""
 
-    metadata_str = json.dumps(metadata, indent=2, sort_keys=True)
+    # Compact output keeps the prompt short; sorted keys keep it identical across runs
+    metadata_str = orjson.dumps(metadata, option=orjson.OPT_SORT_KEYS).decode()
     user_prompt_content = f"File Metadata:\n```json\n{metadata_str}\n```\n\n"
     if text_content:
         user_prompt_content += f"Document Text:\n```\n{text_content}\n```\n"
     else:
         user_prompt_content += "Document contains no text. Analyze based on metadata only.\n"
 
-    if known_names:
-        names_list_str = "\n".join([f"- {name}" for name in known_names])
-        user_prompt_content = f"Reference List of Known Correct Names:\n{names_list_str}\n\n---\n\n{user_prompt_content}"
+    if names_block:
+        user_prompt_content = f"Reference List of Known Correct Names:\n{names_block}\n\n---\n\n{user_prompt_content}"
 
     headers = {"Content-Type": "application/json"}
     data = {
         "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt_content}],
-        "temperature": 0.1, "max_tokens": 800, "stream": False
+        "temperature": 0.1, "max_tokens": 800, "stream": False,
+        "response_format": {"type": "json_schema", "json_schema": {"name": "file_analysis", "strict": True, "schema": LLM_RESPONSE_SCHEMA}}
     }
 
     try:
-        response = requests.post(LLM_URL, headers=headers, json=data, timeout=120)
+        async with semaphore:
+            response = await client.post(LLM_URL, headers=headers, json=data)
         response.raise_for_status()
         llm_output = response.json()['choices'][0]['message']['content']
-        llm_output = llm_output.strip().strip('```json').strip('```').strip()
         return json.loads(llm_output)
     except Exception as e:
         print(f"LLM analysis failed: {e}")
         return None
 
+async def run_llm_analyses(jobs, names_block):
+    """Runs the LLM analysis for every (text_content, metadata) job concurrently, preserving order."""
+    semaphore = asyncio.Semaphore(LLM_NUM_PARALLEL)
+    # One keep-alive connection per concurrent request, reused for the whole batch
+    limits = httpx.Limits(max_connections=LLM_NUM_PARALLEL, max_keepalive_connections=LLM_NUM_PARALLEL)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        return await asyncio.gather(
+            *[get_llm_analysis_async(client, semaphore, text, meta, names_block) for text, meta in jobs],
+            return_exceptions=True
+        )
+
+def resolve_rename(item):
+    """Returns (original_path, new_name, new_path) for a rename request item, or None if it is incomplete."""
+    original_path = item.get('original_path')
+    new_name = item.get('proposed_new_name')
+
+    if not original_path or not new_name: return None
+
+    # Handle deletion marking
+    if item.get('status') == 'marked_for_deletion':
+        new_name = f"DELETE_{os.path.basename(original_path)}"
+
+    return original_path, new_name, os.path.join(os.path.dirname(original_path), new_name)
+
+def apply_rename(item):
+    """Renames one file, returning (ok, original_name, db_update, failure_reason) or None to skip the item."""
+    resolved = resolve_rename(item)
+    if not resolved: return None
+    original_path, new_name, new_path = resolved
+    original_name = os.path.basename(original_path)
+
+    if not os.path.exists(original_path):
+        return False, original_name, None, "Original file not found."
+
+    # os.rename silently overwrites its destination; samefile allows case-only renames
+    if os.path.exists(new_path) and not os.path.samefile(original_path, new_path):
+        return False, original_name, None, f"A file named {new_name} already exists."
+
+    try:
+        os.rename(original_path, new_path)
+
+        # Renaming doesn't change the content, so reuse the hash from /process_files
+        file_hash = item.get('file_hash') or calculate_file_hash(new_path)
+        update = (new_name, new_path, file_hash) if file_hash else None
+        return True, original_name, update, None
+    except Exception as e:
+        return False, original_name, None, str(e)
+
+def plan_renames(renames):
+    """Groups rename items into ordered chains of item indexes, returning (chains, failure reasons by index)."""
+    # Each item in a chain renames onto the path the item before it moves away from; separate chains are independent
+    resolved = [resolve_rename(item) for item in renames]
+    path_key = lambda path: os.path.normcase(os.path.abspath(path))
+    failures = {}
+
+    # Each source and each target may appear only once, otherwise renames would clobber each other
+    source_index, claimed_targets = {}, set()
+    for i, paths in enumerate(resolved):
+        if not paths: continue
+        source, target = path_key(paths[0]), path_key(paths[2])
+        if source in source_index:
+            failures[i] = "This file appears more than once in the batch."
+        elif target in claimed_targets:
+            failures[i] = "Another file in this batch is being renamed to the same name."
+        else:
+            source_index[source] = i
+            claimed_targets.add(target)
+            continue
+        resolved[i] = None
+
+    # An item whose target is another item's source waits for that item to move out first.
+    # Targets are unique, so these dependencies form simple chains or cycles.
+    waits_for = {}
+    for i, paths in enumerate(resolved):
+        if not paths: continue
+        j = source_index.get(path_key(paths[2]))
+        if j is not None and j != i:
+            waits_for[i] = j
+    unblocks = {j: i for i, j in waits_for.items()}
+
+    chains = []
+    for i, paths in enumerate(resolved):
+        if not paths or i in waits_for: continue
+        chain = [i]
+        while chain[-1] in unblocks:
+            chain.append(unblocks[chain[-1]])
+        chains.append(chain)
+    chained = {i for chain in chains for i in chain}
+    for i in waits_for:
+        if i not in chained:
+            failures[i] = "This rename is part of a cycle with other renames in the batch."
+    return chains, failures
+
 def sanitize_filename(name):
-    sanitized = re.sub(r'[\\/:*?"<>|]', '_', name)
-    return re.sub(r'\s+', '-', sanitized).strip().lower()[:100]
+    # split() both collapses whitespace runs and drops leading/trailing whitespace
+    return '-'.join(name.translate(_SANITIZE_TABLE).split())[:100].lower()
 
 # --- API Endpoints ---
 
@@ -184,36 +586,70 @@ def process_files_endpoint():
     if not directory_path or not os.path.isdir(directory_path):
         return jsonify({"error": f"Directory '{directory_path}' not found."}), 404
 
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    files_to_scan = []
-    for root, _, files in os.walk(directory_path):
-        for filename in files:
-            if os.path.splitext(filename)[1].lower() in SUPPORTED_EXTENSIONS:
-                files_to_scan.append(os.path.join(root, filename))
+    print(f"\nScanning {directory_path} for supported files...")
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        # Each file is queued for hashing as soon as the walk finds it, so hashing overlaps the walk
+        futures = [executor.submit(_hash_one, file_path) for file_path in iter_supported_files(directory_path)]
+        results = [future.result() for future in tqdm(futures, desc="Hashing Files", unit="file")]
+    hashes = {file_path: file_hash for file_path, file_hash, _ in results}
+    stat_cache_rows = [row for _, _, row in results if row]
+    files_to_scan = list(hashes)
+
+    if stat_cache_rows:
+        with DB_LOCK:
+            DB.executemany(
+                "INSERT INTO stat_cache (dev, ino, mtime_ns, size, file_hash) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(dev, ino) DO UPDATE SET mtime_ns = excluded.mtime_ns, size = excluded.size, file_hash = excluded.file_hash",
+                stat_cache_rows
+            )
+            DB.commit()
 
     if not files_to_scan:
         return jsonify([]), 200
 
     processed_files_for_review = []
-    print(f"\nFound {len(files_to_scan)} supported files. Checking against database...")
-    for file_path in tqdm(files_to_scan, desc="Processing Files", unit="file"):
+    new_files = []
+    print(f"Found {len(files_to_scan)} supported files. Checking against database...")
+
+    with DB_LOCK:
+        cached_analyses = find_cached_analyses(DB.cursor(), {h for h in hashes.values() if h})
+
+    # A stored analysis is reused only if it was made with the same names.txt and prompt.
+    # Rows from before these were tracked have NULLs and are kept as they are.
+    names_block, names_hash = load_known_names(directory_path)
+    seen_hashes = set()
+    new_paths = []
+    for file_path in files_to_scan:
+        file_hash = hashes.get(file_path)
+        if not file_hash or file_hash in seen_hashes: continue
+        seen_hashes.add(file_hash)  # Skip identical copies later in the same batch
+        if file_hash in cached_analyses:
+            cached_names_hash, cached_prompt_version = cached_analyses[file_hash]
+            if cached_prompt_version is None or (cached_names_hash, cached_prompt_version) == (names_hash, PROMPT_VERSION):
+                continue
+        new_paths.append(file_path)
+
+    # ExifTool runs on a side thread while text is extracted; pool workers come from PROCESS_POOL_CONTEXT,
+    # so they never inherit that thread's locks
+    with ThreadPoolExecutor(max_workers=1) as metadata_executor:
+        metadata_future = metadata_executor.submit(get_external_metadata_batch, new_paths)
+        texts = extract_texts(new_paths)
+        metadatas = metadata_future.result()
+
+    for file_path, text_content in zip(new_paths, texts):
+        new_files.append((file_path, hashes[file_path], text_content, metadatas[file_path]))
+
+    print(f"Requesting LLM analysis for {len(new_files)} new files ({LLM_NUM_PARALLEL} in parallel)...")
+    analyses = asyncio.run(run_llm_analyses([(text, meta) for _, _, text, meta in new_files], names_block))
+
+    rows = []
+    for (file_path, file_hash, _, metadata), llm_analysis in zip(new_files, analyses):
         file_ext = os.path.splitext(file_path)[1]
         filename = os.path.basename(file_path)
-        
-        if not os.path.isfile(file_path): continue
 
-        file_hash = calculate_file_hash(file_path)
-        if not file_hash: continue
-
-        cursor.execute("SELECT id FROM files WHERE file_hash = ?", (file_hash,))
-        if cursor.fetchone(): continue
-
-        text_content = get_file_content(file_path)
-        metadata = get_external_metadata(file_path)
-        
-        llm_analysis = get_llm_analysis(text_content, metadata, directory_path)
+        if isinstance(llm_analysis, Exception):
+            print(f"LLM analysis failed: {llm_analysis}")
+            llm_analysis = None
         if not llm_analysis:
             print(f"Skipping {filename}: LLM analysis failed.")
             continue
@@ -223,11 +659,7 @@ def process_files_endpoint():
         speakers = json.dumps(llm_analysis.get('speakers', []))
         metadata_json = json.dumps(metadata)
 
-        cursor.execute(
-            "INSERT INTO files (file_hash, original_name, original_path, topic, summary, speakers, file_type, metadata) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            (file_hash, filename, file_path, topic, synopsis, speakers, file_ext, metadata_json)
-        )
-        conn.commit()
+        rows.append((file_hash, filename, file_path, topic, synopsis, speakers, file_ext, metadata_json, names_hash, PROMPT_VERSION))
 
         proposed_name = f"{sanitize_filename(topic)}{file_ext}"
         if file_ext == '.txt':
@@ -239,6 +671,7 @@ def process_files_endpoint():
         processed_files_for_review.append({
             "originalName": filename,
             "originalPath": file_path,
+            "fileHash": file_hash,
             "llmTopic": topic,
             "synopsis": synopsis,
             "speakers": llm_analysis.get('speakers', []),
@@ -246,7 +679,18 @@ def process_files_endpoint():
             "fileType": file_ext
         })
 
-    conn.close()
+    with DB_LOCK:
+        # Files with an outdated analysis already have a row, so refresh it in place
+        DB.executemany(
+            """INSERT INTO files (file_hash, original_name, original_path, topic, summary, speakers, file_type, metadata, names_hash, prompt_version)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(file_hash) DO UPDATE SET
+                   topic = excluded.topic, summary = excluded.summary, speakers = excluded.speakers,
+                   metadata = excluded.metadata, names_hash = excluded.names_hash, prompt_version = excluded.prompt_version""",
+            rows
+        )
+        DB.commit()
+
     print(f"Processing complete. Found {len(processed_files_for_review)} new files to review.")
     return jsonify(processed_files_for_review), 200
 
@@ -255,72 +699,71 @@ def save_all_changes_endpoint():
     data = request.get_json()
     renames = data.get('renames', [])
 
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
     successful_renames = 0
     failed_renames = []
-
-    for item in tqdm(renames, desc="Applying Renames", unit="file"):
-        original_path = item.get('original_path')
-        new_name = item.get('proposed_new_name')
-
-        if not original_path or not new_name: continue
-
-        if not os.path.exists(original_path):
-            failed_renames.append({"original": os.path.basename(original_path), "reason": "Original file not found."})
+    updates = []
+
+    results = [None] * len(renames)
+    chains, failures = plan_renames(renames)
+    for i, reason in failures.items():
+        results[i] = (False, os.path.basename(renames[i]['original_path']), None, reason)
+
+    def run_chain(chain):
+        # Runs the chain in order; if a rename fails, its target is still occupied, so the rest can't run
+        for position, i in enumerate(chain):
+            results[i] = apply_rename(renames[i])
+            if not results[i][0]:
+                for blocked in chain[position + 1:]:
+                    results[blocked] = (False, os.path.basename(renames[blocked]['original_path']), None,
+                                        f"Blocked because {results[i][1]} could not be renamed.")
+                return
+
+    # Independent chains (usually single renames) run in a pool and the DB is written once at the end
+    with ThreadPoolExecutor(max_workers=RENAME_WORKERS) as executor:
+        list(tqdm(executor.map(run_chain, chains), total=len(chains), desc="Applying Renames", unit="file"))
+
+    for result in results:
+        if result is None: continue
+        ok, original_name, update, reason = result
+        if not ok:
+            failed_renames.append({"original": original_name, "reason": reason})
             continue
-        
-        # Handle deletion marking
-        if item.get('status') == 'marked_for_deletion':
-            new_name = f"DELETE_{os.path.basename(original_path)}"
-
-        new_path = os.path.join(os.path.dirname(original_path), new_name)
+        if update:
+            updates.append(update)
+        successful_renames += 1
 
-        try:
-            os.rename(original_path, new_path)
-
-            file_hash = calculate_file_hash(new_path)
-            if file_hash:
-                cursor.execute(
-                    "UPDATE files SET new_name = ?, file_path = ? WHERE file_hash = ?",
-                    (new_name, new_path, file_hash)
-                )
-                conn.commit()
-            successful_renames += 1
-        except Exception as e:
-            failed_renames.append({"original": os.path.basename(original_path), "reason": str(e)})
-    
-    conn.close()
+    with DB_LOCK:
+        DB.executemany("UPDATE files SET new_name = ?, file_path = ? WHERE file_hash = ?", updates)
+        DB.commit()
     return jsonify({"successful_renames": successful_renames, "failed_renames": failed_renames}), 200
 
 @app.route('/search', methods=['GET'])
 def search_files_endpoint():
     query = request.args.get('q', '')
     if not query: return jsonify([])
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    search_term = f"%{query}%"
-    cursor.execute("SELECT * FROM files WHERE topic LIKE ? OR summary LIKE ? OR original_name LIKE ? OR new_name LIKE ? OR speakers LIKE ? OR metadata LIKE ? ORDER BY created_at DESC",
-                   (search_term, search_term, search_term, search_term, search_term, search_term))
-    results = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    fts_query = to_fts_query(query)
+    if not fts_query: return jsonify([])
+    with DB_LOCK:
+        cursor = DB.cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute("SELECT f.* FROM files_fts JOIN files f ON f.id = files_fts.rowid WHERE files_fts MATCH ? ORDER BY rank",
+                       (fts_query,))
+        results = [dict(row) for row in cursor.fetchall()]
     return jsonify(results)
 
 @app.route('/browse_files', methods=['GET'])
 def browse_files_endpoint():
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 20, type=int)
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(id) FROM files")
-    total_files = cursor.fetchone()[0]
-    total_pages = math.ceil(total_files / per_page)
-    offset = (page - 1) * per_page
-    cursor.execute("SELECT * FROM files ORDER BY created_at DESC LIMIT ? OFFSET ?", (per_page, offset))
-    files = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    with DB_LOCK:
+        cursor = DB.cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute("SELECT COUNT(id) FROM files")
+        total_files = cursor.fetchone()[0]
+        total_pages = math.ceil(total_files / per_page)
+        offset = (page - 1) * per_page
+        cursor.execute("SELECT * FROM files ORDER BY created_at DESC LIMIT ? OFFSET ?", (per_page, offset))
+        files = [dict(row) for row in cursor.fetchall()]
     return jsonify({"files": files, "total_pages": total_pages, "current_page": page, "total_files": total_files})
 
 @app.route('/open_file', methods=['POST'])
@@ -374,13 +817,13 @@ def clear_directory_cache_endpoint():
     if not directory_path or not os.path.isdir(directory_path):
         return jsonify({"error": "Invalid or missing directory path."}), 400
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        path_pattern = os.path.join(directory_path, '') + '%'
-        cursor.execute("DELETE FROM files WHERE original_path LIKE ?", (path_pattern,))
-        conn.commit()
-        deleted_rows = cursor.rowcount
-        conn.close()
+        # A half-open range on the prefix can use idx_files_original_path; LIKE is case-insensitive and can't
+        path_prefix = os.path.join(directory_path, '')
+        path_upper_bound = path_prefix[:-1] + chr(ord(path_prefix[-1]) + 1)
+        with DB_LOCK:
+            cursor = DB.execute("DELETE FROM files WHERE original_path >= ? AND original_path < ?", (path_prefix, path_upper_bound))
+            DB.commit()
+            deleted_rows = cursor.rowcount
         return jsonify({"message": f"Cleared {deleted_rows} records for directory."}), 200
     except Exception as e:
         return jsonify({"error": f"Failed to clear directory cache: {e}"}), 500
@@ -388,11 +831,10 @@ def clear_directory_cache_endpoint():
 @app.route('/clear_database', methods=['POST'])
 def clear_database_endpoint():
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM files")
-        conn.commit()
-        conn.close()
+        with DB_LOCK:
+            DB.execute("DELETE FROM files")
+            DB.execute("DELETE FROM stat_cache")
+            DB.commit()
         return jsonify({"message": "Database cleared successfully."}), 200
     except Exception as e:
         return jsonify({"error": f"Failed to clear database: {e}"}), 500